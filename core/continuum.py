@@ -1,16 +1,21 @@
+import warnings
 import numpy as np
 from core import my_module
 
 
 def apply_continuum(x, y):
-    x_new, y_new, continuum = my_module.continuum_removal(
-        x,
-        y,
-        'uh',
-        -np.inf,
-        -np.inf,
-        np.inf,
-        np.inf
-    )
+    # the GUI always uses the full spectrum, so skip the windowed entry point
+    x_new, y_new, continuum = my_module.continuum_removal_uh(x, y)
 
     return x_new, y_new
+
+
+# compile (or load from the numba cache) the float32 kernel used for library
+# spectra at import so the first continuum toggle does not stall on the JIT
+try:
+    my_module.continuum_removal_uh(
+        np.array([0.0, 1.0, 2.0, 3.0], dtype=np.float32),
+        np.array([1.0, 0.5, 0.7, 1.0], dtype=np.float32),
+    )
+except Exception as e:
+    warnings.warn(f"Could not precompile continuum_removal_uh: {e}")
@@ -18,10 +18,10 @@ class SpectralDatabase:
         """
         return list(self.db.query(sql))
 
-    def search(self, keyword):
+    def get_all_samples(self):
         sql = """
         SELECT LibName, SampleID, Description
         FROM Samples
-        WHERE Description LIKE ?
         """
-        return list(self.db.query(sql, (f"%{keyword}%",)))
\ No newline at end of file
+        return list(self.db.query(sql))
+
@@ -1,24 +1,28 @@
 import numpy as np
 from numba import njit
 import spectral
+import threading
 import warnings
 from pathlib import Path
 
 numba_cache_flag = True
+numba_safe_fastmath_flags = {"nsz", "arcp", "contract", "afn", "reassoc"}
 
 DEFAULT_DB_PATH = Path(__file__).resolve(
 ).parent.parent / "data" / "usgs_splib07a.db"
 
 
-@njit(cache=numba_cache_flag)
+@njit(cache=numba_cache_flag, fastmath=True, boundscheck=False,
+      error_model="numpy", nogil=True, inline="always")
 def left_turn_for_convex_hull(x1, y1, x2, y2, x3, y3):
-    slope1 = (y2 - y1) / (x2 - x1)
-    slope2 = (y3 - y2) / (x3 - x2)
-    left_turn_flag = slope2 > slope1
+    # cross product of (p2 - p1) and (p3 - p2); no divisions, so vertical
+    # segments cannot produce NaN/Inf
+    left_turn_flag = (x2 - x1) * (y3 - y2) > (y2 - y1) * (x3 - x2)
     return left_turn_flag
 
 
-@njit(cache=numba_cache_flag)
+@njit(cache=numba_cache_flag, fastmath=True, boundscheck=False,
+      error_model="numpy", nogil=True)
 def upper_convex_hull(x, y):
     n = x.size
 
@@ -28,33 +32,31 @@ def upper_convex_hull(x, y):
     if n <= 2:
         raise ValueError("x and y lenghts must be grater than 2")
 
-    hullx = np.full((n,), np.nan)
-    hully = np.full((n,), np.nan)
+    stack = np.empty(n, np.int32)
 
-    hullx[0], hully[0] = x[0], y[0]
-    hullx[1], hully[1] = x[1], y[1]
+    stack[0], stack[1] = 0, 1
 
     nh = 2
 
     for i in range(2, n):
         while nh >= 2 and left_turn_for_convex_hull(
-            hullx[nh - 2],
-            hully[nh - 2],
-            hullx[nh - 1],
-            hully[nh - 1],
+            x[stack[nh - 2]],
+            y[stack[nh - 2]],
+            x[stack[nh - 1]],
+            y[stack[nh - 1]],
             x[i],
             y[i],
         ):
             nh -= 1
 
-        hullx[nh] = x[i]
-        hully[nh] = y[i]
+        stack[nh] = i
         nh += 1
 
-    return hullx[:nh], hully[:nh]
+    return x[stack[:nh]], y[stack[:nh]]
 
 
-@njit(cache=numba_cache_flag)
+@njit(cache=numba_cache_flag, fastmath=True, boundscheck=False,
+      error_model="numpy", nogil=True)
 def lower_convex_hull(x, y):
     n = x.size
 
@@ -64,33 +66,140 @@ def lower_convex_hull(x, y):
     if n <= 2:
         raise ValueError("x and y lenghts must be grater than 2")
 
-    hullx = np.full((n,), np.nan)
-    hully = np.full((n,), np.nan)
+    stack = np.empty(n, np.int32)
 
-    hullx[0], hully[0] = x[0], y[0]
-    hullx[1], hully[1] = x[1], y[1]
+    stack[0], stack[1] = 0, 1
 
     nh = 2
 
     for i in range(2, n):
-        while nh >= 2 and not left_turn_for_convex_hull(
-            hullx[nh - 2],
-            hully[nh - 2],
-            hullx[nh - 1],
-            hully[nh - 1],
+        # mirrored about the x axis a right turn becomes a left turn, so the
+        # lower hull shares the upper hull predicate
+        while nh >= 2 and left_turn_for_convex_hull(
+            x[stack[nh - 2]],
+            -y[stack[nh - 2]],
+            x[stack[nh - 1]],
+            -y[stack[nh - 1]],
             x[i],
-            y[i],
+            -y[i],
         ):
             nh -= 1
 
-        hullx[nh] = x[i]
-        hully[nh] = y[i]
+        stack[nh] = i
         nh += 1
 
-    return hullx[:nh], hully[:nh]
+    return x[stack[:nh]], y[stack[:nh]]
+
+
+@njit(cache=numba_cache_flag, fastmath=True, boundscheck=False,
+      error_model="numpy", nogil=True)
+def _interp_monotone_sorted(x, hx, hy, out):
+    # linear interpolation of (hx, hy) at x; both x and hx are increasing,
+    # so the hull segment index only ever moves forward
+    nh = hx.size
+    j = 0
+
+    for i in range(x.size):
+        xi = x[i]
+
+        if xi <= hx[0]:
+            out[i] = hy[0]
+            continue
+
+        if xi >= hx[nh - 1]:
+            out[i] = hy[nh - 1]
+            continue
+
+        while hx[j + 1] < xi:
+            j += 1
+
+        t = (xi - hx[j]) / (hx[j + 1] - hx[j])
+        out[i] = hy[j] + t * (hy[j + 1] - hy[j])
+
+    return out
+
+
+@njit(cache=numba_cache_flag, fastmath=True, boundscheck=False,
+      error_model="numpy", nogil=True)
+def _prefilter_upper(x, y, block=32):
+    # Akl-Toussaint style filter for the upper hull of an x-sorted chain:
+    # the end points and each block maximum are anchors, and a point lying
+    # strictly below the chord between its neighbouring anchors is under
+    # the hull, so it cannot be a hull vertex. Returns the surviving indices.
+    n = x.size
 
+    anchors = np.empty(n // block + 3, np.int32)
+    anchors[0] = 0
+    na = 1
+
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        m = start + np.argmax(y[start:stop])
+
+        if m > anchors[na - 1]:
+            anchors[na] = m
+            na += 1
+
+    if anchors[na - 1] != n - 1:
+        anchors[na] = n - 1
+        na += 1
+
+    keep = np.empty(n, np.int32)
+    nk = 0
+
+    for k in range(na - 1):
+        a = anchors[k]
+        b = anchors[k + 1]
+
+        keep[nk] = a
+        nk += 1
+
+        for i in range(a + 1, b):
+            # a left turn at i means i is below the chord a-b
+            if not left_turn_for_convex_hull(
+                x[a], y[a], x[i], y[i], x[b], y[b]
+            ):
+                keep[nk] = i
+                nk += 1
+
+    keep[nk] = anchors[na - 1]
+    nk += 1
+
+    return keep[:nk]
+
+
+@njit(cache=numba_cache_flag, fastmath=True, boundscheck=False,
+      error_model="numpy", nogil=True)
+def continuum_removal_uh(x, y):
+    # upper hull continuum over the whole spectrum, without any window
+    if x.size != y.size:
+        raise ValueError("x and y lenghts must be same")
 
-@njit(cache=numba_cache_flag)
+    if x.size <= 2:
+        raise ValueError("x and y lenghts must be grater than 2")
+
+    keep = _prefilter_upper(x, y)
+    xk = x[keep]
+    yk = y[keep]
+
+    if keep.size > 2:
+        hullx, hully = upper_convex_hull(xk, yk)
+    else:
+        hullx, hully = xk, yk
+
+    c = np.empty_like(y)
+    _interp_monotone_sorted(x, hullx, hully, c)
+
+    Cy = y / c
+
+    return x, Cy, c
+
+
+# the bounds may be +-inf or NaN, so the bound checks below are compiled
+# without the nnan/ninf fastmath flags; continuum_removal_uh itself still
+# uses full fastmath
+@njit(cache=numba_cache_flag, fastmath=numba_safe_fastmath_flags,
+      boundscheck=False, error_model="numpy", nogil=True)
 def continuum_removal(
     x,
     y,
@@ -103,16 +212,19 @@ def continuum_removal(
     if continuum_type == "uh":
         x_min, x_max = left_inner_x, right_inner_x
 
-        flag = (x_min <= x) * (x <= x_max)
-
-        x = x[flag]
-        y = y[flag]
+        if np.isnan(x_min) or np.isnan(x_max):
+            raise ValueError("inner x values must not be NaN")
 
-        hullx, hully = upper_convex_hull(x, y)
+        # infinite bounds keep every sample, so only trim for a real window
+        if np.isfinite(x_min) or np.isfinite(x_max):
+            # x is sorted, so the window is a contiguous slice (a view)
+            lo = np.searchsorted(x, x_min, side="left")
+            hi = np.searchsorted(x, x_max, side="right")
 
-        c = np.interp(x, hullx, hully)
+            x = x[lo:hi]
+            y = y[lo:hi]
 
-        Cy = y / c
+        x, Cy, c = continuum_removal_uh(x, y)
 
     else:
         raise ValueError(
@@ -123,6 +235,34 @@ def continuum_removal(
     return x, Cy, c
 
 
+# sqlite3 connections may only be used by the thread that opened them, so
+# each thread keeps its own
+_db_local = threading.local()
+
+
+def _get_db(library_path):
+    if getattr(_db_local, "library_path", None) != library_path:
+        _db_local.db = spectral.USGSDatabase(library_path)
+        _db_local.library_path = library_path
+
+    return _db_local.db
+
+
+# parsed bandpass arrays keyed on (library_path, Spectrometer); a bandpass is
+# shared by every sample measured with the same spectrometer
+_FWHM_CACHE = {}
+
+# sample metadata and the id of its spectrometer bandpass in a single
+# statement; the bandpass blob itself is only read on a _FWHM_CACHE miss
+_SAMPLE_SQL = """SELECT s.LibName, s.SampleID, s.Description, s.Spectrometer,
+                        sd.SpectrometerDataID
+                 FROM Samples s
+                 LEFT JOIN SpectrometerData sd
+                     ON sd.Name = s.Spectrometer
+                     AND sd.MeasurementType = 'Bandpass'
+                 WHERE {} LIMIT 1"""
+
+
 def get_usgs_splib07a_spectrum(
     search_str="",
     SampleID=None,
@@ -131,57 +271,69 @@ def get_usgs_splib07a_spectrum(
     if (len(search_str) == 0) and (SampleID is None):
         raise ValueError("Wrong arguments for getting library spectrum")
 
-    db = spectral.USGSDatabase(str(library_path))
+    library_path = str(library_path)
+    db = _get_db(library_path)
 
     if SampleID is None:
-        sql_str = """SELECT LibName, SampleID, Description, Spectrometer
-                     FROM Samples WHERE Description LIKE ?"""
+        sql_str = _SAMPLE_SQL.format("s.Description LIKE ?")
 
         query = db.query(sql_str, args=(f"%{search_str}%",))
 
-        first_result = list(query)[0]
-
-        lib_name = first_result[0]
-        SampleID = first_result[1]
-        Description = first_result[2]
-        Spectrometer = first_result[3]
-
     else:
         SampleID = int(SampleID) if type(SampleID) is not int else SampleID
 
-        sql_str = """SELECT LibName, SampleID, Description, Spectrometer
-                     FROM Samples WHERE SampleID = ?"""
+        sql_str = _SAMPLE_SQL.format("s.SampleID = ?")
 
         query = db.query(sql_str, args=(SampleID,))
 
-        first_result = list(query)[0]
+    first_result = query.fetchone()
 
-        lib_name = first_result[0]
-        Description = first_result[2]
-        Spectrometer = first_result[3]
+    if first_result is None:
+        raise ValueError("No library spectrum matches the arguments")
+
+    lib_name = first_result[0]
+    SampleID = first_result[1]
+    Description = first_result[2]
+    Spectrometer = first_result[3]
+    bandpass_id = first_result[4]
 
     x, y = db.get_spectrum(SampleID)
 
-    x = np.array(x)
-    y = np.array(y)
+    # the library stores float32 values; keeping them halves the memory
+    # traffic through the hull loops
+    x = np.asarray(x, dtype=np.float32)
+    y = np.asarray(y, dtype=np.float32)
+
+    # positive samples located once and shared by every gather below
+    idx = np.flatnonzero(y > 0)
+    keep_all = idx.size == y.size
+    x, y = x.take(idx), y.take(idx)
 
-    flag = y > 0
-    x, y = x[flag], y[flag]
+    if bandpass_id is not None:
+        key = (library_path, Spectrometer)
+        fwhm = _FWHM_CACHE.get(key)
 
-    sql_str = """SELECT ValuesArray FROM SpectrometerData
-                 WHERE MeasurementType = "Bandpass" AND Name = ?"""
+        if fwhm is None:
+            sql_str = """SELECT ValuesArray FROM SpectrometerData
+                         WHERE SpectrometerDataID = ?"""
 
-    query = db.query(sql_str, (Spectrometer,))
+            bandpass_blob = db.query(sql_str, (bandpass_id,)).fetchone()[0]
 
-    rows = query.fetchall()
+            fwhm = spectral.database.usgs.array_from_blob(bandpass_blob)
+            fwhm = np.asarray(fwhm, dtype=np.float32)
+            # shared between callers, so guard it against in-place edits
+            fwhm.setflags(write=False)
+            _FWHM_CACHE[key] = fwhm
 
-    if len(rows) > 0:
-        fwhm = spectral.database.usgs.array_from_blob(rows[0][0])
-        fwhm = np.array(fwhm)
-        fwhm = fwhm[flag]
+        if not keep_all:
+            fwhm = fwhm.take(idx)
 
     else:
         warnings.warn(f"Bandpass not found for {Description} in {lib_name}")
-        fwhm = np.full(x.size, np.nan)
+        fwhm = np.full(x.size, np.nan, dtype=x.dtype)
+
+    # fwhm is always returned read-only, since it may be the cached array
+    # itself; callers that need to modify it must copy it first
+    fwhm.setflags(write=False)
 
     return x, y, fwhm, Description, SampleID, lib_name
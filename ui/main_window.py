@@ -1,7 +1,9 @@
 import tkinter as tk
 from tkinter import ttk
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 import matplotlib.pyplot as plt
+import numpy as np
 
 from core.database import SpectralDatabase
 from core.spectrum_loader import load_spectrum
@@ -20,6 +22,14 @@ class MainWindow:
         self.continuum_on = False
         self.current_sample_id = None
 
+        # the jitted continuum kernel releases the GIL, so it runs off the Tk
+        # thread; results are picked up by polling from the event loop, since
+        # Tk must only be called from its own thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+        self._search_job = None
+
         self._build_ui()
         self._load_minerals()
 
@@ -60,6 +70,12 @@ class MainWindow:
 
         self.fig, self.ax = plt.subplots()
 
+        # one line artist is reused for every spectrum
+        self._line, = self.ax.plot([], [], linewidth=1.5)
+
+        self.ax.set_xlabel("Wavelength (µm)")
+        self.ax.set_ylabel("Reflectance")
+
         self.canvas = FigureCanvasTkAgg(self.fig, master=right_frame)
         self.canvas.draw()
         self.canvas.get_tk_widget().pack(fill="both", expand=True)
@@ -68,23 +84,58 @@ class MainWindow:
         toolbar.update()
 
     def _load_minerals(self):
-        self.entries = self.db.get_all_minerals()
+        # list labels and sample ids are kept as parallel sequences indexed
+        # by listbox row
+        minerals = self.db.get_all_minerals()
+        self.entries = [f"{desc} ({sid})" for lib, sid, desc in minerals]
+        self.sample_id_arr = np.array(
+            [sid for lib, sid, desc in minerals], dtype=np.int64
+        )
+
         self.filtered = self.entries
+        self.filtered_ids = self.sample_id_arr
+
+        # searches cover every sample, like the SQL LIKE query they replace,
+        # but against descriptions that are loaded and case-folded only once
+        samples = self.db.get_all_samples()
+        self._search_labels = [f"{desc} ({sid})" for lib, sid, desc in samples]
+        self._search_ids = np.array(
+            [sid for lib, sid, desc in samples], dtype=np.int64
+        )
+        self._search_keys = [
+            (desc or "").casefold() for lib, sid, desc in samples
+        ]
+
         self._refresh_listbox()
 
     def _refresh_listbox(self):
         self.listbox.delete(0, tk.END)
 
-        for lib, sid, desc in self.filtered:
-            self.listbox.insert(tk.END, f"{desc} ({sid})")
+        # a single insert call redraws the listbox once for all rows
+        self.listbox.insert(tk.END, *self.filtered)
 
     def _update_search(self, *args):
-        keyword = self.search_var.get().strip()
+
+        # wait for a pause in typing instead of searching on every key
+        if self._search_job is not None:
+            self.root.after_cancel(self._search_job)
+
+        self._search_job = self.root.after(150, self._run_search)
+
+    def _run_search(self):
+        self._search_job = None
+
+        keyword = self.search_var.get().strip().casefold()
 
         if keyword:
-            self.filtered = self.db.search(keyword)
+            hits = [
+                i for i, key in enumerate(self._search_keys) if keyword in key
+            ]
+            self.filtered = [self._search_labels[i] for i in hits]
+            self.filtered_ids = self._search_ids[hits]
         else:
             self.filtered = self.entries
+            self.filtered_ids = self.sample_id_arr
 
         self._refresh_listbox()
 
@@ -93,19 +144,37 @@ class MainWindow:
         x, y = load_spectrum(sample_id)
 
         if self.continuum_on:
-            x, y = apply_continuum(x, y)
+            self._pending = self._executor.submit(apply_continuum, x, y)
+            self._poll_continuum(self._pending)
+        else:
+            self._pending = None
+            self._draw_spectrum(x, y)
 
-        self.ax.clear()
+    def _poll_continuum(self, future):
 
-        self.ax.plot(x, y, linewidth=1.5)
+        # a newer selection or toggle superseded this result
+        if future is not self._pending:
+            return
 
-        self.ax.set_xlabel("Wavelength (µm)")
-        self.ax.set_ylabel("Reflectance")
+        # the kernel takes microseconds, so poll tightly rather than adding a
+        # visible delay to every redraw
+        if not future.done():
+            self.root.after(1, self._poll_continuum, future)
+            return
+
+        self._pending = None
+        self._draw_spectrum(*future.result())
+
+    def _draw_spectrum(self, x, y):
 
+        self._line.set_data(x, y)
+
+        # toolbar zoom/pan turns autoscaling off; ax.clear() used to reset it
+        self.ax.set_autoscale_on(True)
         self.ax.relim()
         self.ax.autoscale_view()
 
-        self.canvas.draw()
+        self.canvas.draw_idle()
 
     def _on_select(self, event):
 
@@ -115,7 +184,7 @@ class MainWindow:
             return
 
         index = selection[0]
-        lib, sample_id, desc = self.filtered[index]
+        sample_id = int(self.filtered_ids[index])
 
         self.current_sample_id = sample_id
 